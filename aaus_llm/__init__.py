@@ -0,0 +1 @@
+from .aau_llm import consultar_llm_async, aclose_sessions, configure, AausLLM
@@ -1,19 +1,680 @@
 import aiohttp
 import asyncio
-import openai # Make sure this matches the version dependency in pyproject.toml
-import base64
+import binascii
+import datetime
+import email.utils
+import functools
+import io
+import json
 import logging
-from typing import Optional # Good practice for type hints
+import os
+import random
+import sys
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Union # Good practice for type hints
+
+try:
+    # Optional: SIMD (AVX2/AVX-512) base64, much faster for large images. Encodes straight
+    # to str, avoiding the intermediate bytes object of b64encode().decode().
+    from pybase64 import b64encode_as_string as _b64encode_str
+except ImportError:
+    import base64
+
+    def _b64encode_str(data: bytes) -> str:
+        return base64.b64encode(data).decode('ascii')
+
+try:
+    # Optional: C JSON encoder/decoder, much faster than stdlib json with multi-MB base64 payloads
+    import orjson
+    _json_dumps = orjson.dumps # -> bytes
+    _json_loads = orjson.loads # Accepts bytes directly
+except ImportError:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+    _json_loads = json.loads
+
+
+# Bodies above this size (aiohttp's threshold, 1 MiB) are sent from a BytesIO: raw bytes that large
+# make aiohttp emit a ResourceWarning about locking the event loop
+_LARGE_BODY_BYTES = 1024 * 1024
+
+
+def _json_body(payload: Dict[str, Any]) -> aiohttp.payload.Payload:
+    """
+    Cuerpo JSON ya serializado a bytes. El propio payload aporta la cabecera Content-Type,
+    así que no hace falta pasarla en cada llamada (y funciona igual con cualquier sesión).
+    Se construye en cada intento: un BytesIOPayload solo puede enviarse una vez.
+    """
+    body = _json_dumps(payload)
+    if len(body) > _LARGE_BODY_BYTES: # Multimodal requests with a large base64 image
+        return aiohttp.BytesIOPayload(io.BytesIO(body), content_type="application/json")
+    return aiohttp.BytesPayload(body, content_type="application/json")
+
+try:
+    # Optional: lets aiohttp resolve names asynchronously (c-ares) instead of calling getaddrinfo
+    # in a thread pool for every new connection
+    import aiodns # noqa: F401
+    # aiodns refuses to run on Windows' default ProactorEventLoop; keep the threaded resolver there
+    _HAS_AIODNS = sys.platform != "win32"
+except ImportError:
+    _HAS_AIODNS = False
 
 # Configurar log
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Sesiones HTTP compartidas por proveedor: reutilizan conexiones keep-alive (y TLS) entre llamadas
+# en lugar de abrir una ClientSession nueva en cada consulta.
+_sessions: Dict[str, aiohttp.ClientSession] = {}
+_session_loops: Dict[str, asyncio.AbstractEventLoop] = {} # Loop al que pertenece cada sesión
+
+# Límites del pool de conexiones de las sesiones compartidas (ajustables con configure())
+_connector_limit = 0            # 0 = sin límite global (aiohttp usa 100 por defecto)
+_connector_limit_per_host = 64  # Conexiones simultáneas por host
+
+# Máximo de consultas en curso por proveedor, para no disparar límites de tasa (429) bajo asyncio.gather
+_concurrency: Dict[str, int] = {"openai": 20, "groq": 10, "ollama": 4}
+_provider_sems: Dict[str, asyncio.Semaphore] = {}
+_sem_loops: Dict[str, asyncio.AbstractEventLoop] = {} # Loop al que pertenece cada semáforo
+
+
+def configure(
+    connector_limit: Optional[int] = None,
+    connector_limit_per_host: Optional[int] = None,
+    concurrency: Optional[Dict[str, int]] = None
+    ) -> None:
+    """
+    Ajusta los límites del pool de conexiones y de concurrencia por proveedor.
+
+    Los límites del pool aplican a las sesiones creadas a partir de ese momento; llamar
+    antes de la primera consulta o tras aclose_sessions().
+
+    :param connector_limit: Máximo de conexiones simultáneas en total (0 = sin límite)
+    :param connector_limit_per_host: Máximo de conexiones simultáneas por host. Ollama
+        atiende todo desde un único host, así que se beneficia de un valor alto.
+    :param concurrency: Máximo de consultas en curso por proveedor, p.ej. {"groq": 5}
+        (default: openai=20, groq=10, ollama=4)
+    """
+    global _connector_limit, _connector_limit_per_host
+    if connector_limit is not None:
+        _connector_limit = connector_limit
+    if connector_limit_per_host is not None:
+        _connector_limit_per_host = connector_limit_per_host
+    if concurrency is not None:
+        _concurrency.update(concurrency)
+        _provider_sems.clear() # Se recrean con los nuevos límites en la próxima consulta
+        _sem_loops.clear()
+
+
+def _get_semaphore(provider: str) -> asyncio.Semaphore:
+    """
+    Devuelve el semáforo de concurrencia del proveedor, creándolo en el loop actual si hace falta.
+    """
+    loop = asyncio.get_running_loop()
+    sem = _provider_sems.get(provider)
+    if sem is None or _sem_loops.get(provider) is not loop:
+        sem = asyncio.Semaphore(_concurrency.get(provider, 10))
+        _provider_sems[provider] = sem
+        _sem_loops[provider] = loop
+    return sem
+
+
+def _new_connector(unix_path: Optional[str] = None) -> aiohttp.BaseConnector:
+    """
+    Connector con los límites configurados (ver configure()). Con unix_path se conecta
+    a ese socket Unix en lugar de por TCP. Debe crearse con el event loop en marcha.
+    """
+    if unix_path:
+        # Local socket: no DNS and no TCP loopback round trip
+        return aiohttp.UnixConnector(
+            path=unix_path,
+            limit=_connector_limit,
+            limit_per_host=_connector_limit_per_host,
+            keepalive_timeout=75
+        )
+    return aiohttp.TCPConnector(
+        limit=_connector_limit,
+        limit_per_host=_connector_limit_per_host,
+        resolver=aiohttp.AsyncResolver() if _HAS_AIODNS else None,
+        ttl_dns_cache=600, # API hosts rarely change; skip DNS lookups on new connections
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+
+
+def _unix_socket_path(url_base: Optional[str]) -> Optional[str]:
+    """
+    Ruta del socket si url_base es de la forma unix:///ruta/al/socket, o None.
+    """
+    if url_base and url_base.startswith("unix://"):
+        return url_base[len("unix://"):]
+    return None
+
+
+async def _get_session(provider: str, unix_path: Optional[str] = None) -> aiohttp.ClientSession:
+    """
+    Devuelve la sesión compartida del proveedor, creándola si no existe, está cerrada
+    o pertenece a otro event loop (p.ej. tras varias llamadas a asyncio.run).
+
+    Con unix_path la sesión se conecta a ese socket Unix en lugar de por TCP (Ollama local).
+    """
+    key = f"{provider}+unix:{unix_path}" if unix_path else provider
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(key)
+    if session is None or session.closed or _session_loops.get(key) is not loop:
+        session = aiohttp.ClientSession(connector=_new_connector(unix_path))
+        _sessions[key] = session
+        _session_loops[key] = loop
+        logger.debug("Nueva sesión HTTP compartida para '%s'", key)
+    return session
+
+
+async def aclose_sessions() -> None:
+    """
+    Cierra las sesiones HTTP compartidas. Llamar al finalizar la aplicación
+    (p.ej. al final de main()) para liberar las conexiones abiertas.
+    """
+    loop = asyncio.get_running_loop()
+    for key, session in list(_sessions.items()):
+        # Sessions bound to another (already closed) loop cannot be closed from here; just drop them
+        if _session_loops.get(key) is loop and not session.closed:
+            await session.close()
+    _sessions.clear()
+    _session_loops.clear()
+
+# HTTP statuses worth retrying: timeouts, rate limiting and transient server errors
+_RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Transient failures that may succeed on a new attempt
+_RETRYABLE_ERRORS = (
+    aiohttp.ClientConnectionError, # Includes ServerDisconnectedError and connect/read timeouts
+    aiohttp.ClientPayloadError,    # Response body cut off mid-transfer
+    asyncio.TimeoutError,
+)
+
+# Same for the OpenAI SDK (openai.error.*), looked up by name: the SDK is only imported by the first
+# OpenAI query, so Ollama/Groq-only applications never pay for importing it
+_OPENAI_RETRYABLE_ERRORS = ("APIConnectionError", "Timeout", "RateLimitError", "ServiceUnavailableError", "TryAgain")
+
+
+def _is_retryable(err: BaseException) -> bool:
+    """
+    Indica si merece la pena reintentar tras el error (error recuperable) o hay que
+    propagarlo inmediatamente.
+    """
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status in _RETRYABLE_STATUS
+    openai_error = getattr(sys.modules.get("openai"), "error", None) # None until an OpenAI query was made
+    if openai_error is not None and isinstance(err, openai_error.OpenAIError):
+        if isinstance(err, openai_error.APIError) and err.http_status in _RETRYABLE_STATUS:
+            return True
+        return isinstance(err, tuple(getattr(openai_error, name) for name in _OPENAI_RETRYABLE_ERRORS))
+    return isinstance(err, _RETRYABLE_ERRORS)
+
+
+def _retry_after(err: BaseException) -> Optional[float]:
+    """
+    Segundos de espera que pide el servidor en la cabecera Retry-After (429/503), si la hay.
+    Acepta tanto segundos como una fecha HTTP.
+    """
+    headers = getattr(err, "headers", None) # aiohttp.ClientResponseError and openai.error.OpenAIError
+    value = headers.get("Retry-After") if headers else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        fecha = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if fecha.tzinfo is None:
+        fecha = fecha.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (fecha - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def _backoff_delay(intento: int, base_delay: float, max_delay: float) -> float:
+    """
+    Espera antes del siguiente reintento: backoff exponencial con jitter, para que las
+    consultas concurrentes que fallan a la vez no reintenten todas al mismo tiempo.
+    """
+    return min(max_delay, base_delay * (2 ** intento)) * (1 + random.random() * 0.5)
+
+
+@functools.lru_cache(maxsize=4)
+def _sync_read_b64(path: str, mtime_ns: int, size: int) -> str:
+    """
+    Lee y codifica en base64 una imagen. mtime_ns y size solo forman parte de la clave
+    de la caché, para que un archivo modificado se vuelva a leer.
+    """
+    # Read straight into a buffer sized from stat() instead of letting f.read() grow one,
+    # and encode from a memoryview so no extra copy of the raw bytes is made
+    buf = bytearray(size)
+    with open(path, "rb") as f:
+        n = f.readinto(buf)
+    return _b64encode_str(memoryview(buf)[:n])
+
+
+async def _read_b64(path: str) -> str:
+    """
+    Devuelve la imagen en base64 sin bloquear el event loop: la lectura y la codificación
+    se hacen en el executor por defecto, y el resultado se cachea por (ruta, mtime, tamaño)
+    para reutilizarlo entre reintentos y proveedores.
+    """
+    def _stat_and_read() -> str:
+        st = os.stat(path)
+        return _sync_read_b64(path, st.st_mtime_ns, st.st_size)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _stat_and_read)
+
+def _truncate_for_log(value: Any, max_chars: int = 100, max_items: int = 20) -> Any:
+    """
+    Copia de un valor JSON (payload, mensajes, respuesta) apta para logs: recorta los textos
+    largos, como las imágenes base64, y las listas largas, como el "context" de Ollama.
+    """
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else value[:max_chars] + "..."
+    if isinstance(value, dict):
+        return {k: _truncate_for_log(v, max_chars, max_items) for k, v in value.items()}
+    if isinstance(value, list):
+        items = [_truncate_for_log(v, max_chars, max_items) for v in value[:max_items]]
+        if len(value) > max_items:
+            items.append(f"... ({len(value) - max_items} más)")
+        return items
+    return value
+
+
+def _response_too_large(max_bytes: int) -> ValueError:
+    logger.error("Respuesta demasiado grande (más de %s bytes), se descarta.", max_bytes)
+    return ValueError(f"Respuesta demasiado grande (más de {max_bytes} bytes)")
+
+
+async def _read_body(resp: aiohttp.ClientResponse, max_bytes: int) -> bytes:
+    """
+    Lee el cuerpo completo de la respuesta sin pasar de max_bytes, para que un servidor
+    que devuelve un cuerpo desmesurado no agote la memoria.
+    """
+    if resp.content_length is not None and resp.content_length > max_bytes:
+        raise _response_too_large(max_bytes)
+    try:
+        await resp.content.readexactly(max_bytes + 1)
+    except asyncio.IncompleteReadError as eof:
+        return eof.partial # Body ended before the limit: this is the whole response
+    raise _response_too_large(max_bytes)
+
+
+async def _raise_for_ollama_status(resp: aiohttp.ClientResponse, max_bytes: int) -> None:
+    """
+    Como resp.raise_for_status(), pero usando como mensaje el campo "error" del cuerpo JSON
+    de Ollama (p.ej. 'model "llava" not found, try pulling it first') en lugar de solo el
+    texto del estado HTTP.
+    """
+    if resp.status < 400:
+        return
+    message = resp.reason
+    try:
+        # Error bodies are small; cap the read anyway
+        error = _json_loads(await _read_body(resp, min(max_bytes, 64 * 1024))).get("error")
+        if error:
+            message = str(error)
+    except Exception: # Not JSON, too large or cut off: keep the HTTP reason
+        pass
+    raise aiohttp.ClientResponseError(
+        resp.request_info,
+        resp.history,
+        status=resp.status,
+        message=message,
+        headers=resp.headers # Keeps Retry-After available to the retry loop
+    )
+
+
+async def _read_ollama_stream(resp: aiohttp.ClientResponse, on_token: Callable[[str], Any], max_bytes: int) -> str:
+    """
+    Lee una respuesta de Ollama con "stream": true (un objeto JSON por línea), pasando
+    cada fragmento a on_token según llega. Devuelve el texto completo.
+    """
+    parts = []
+    received = 0
+    async for line in resp.content:
+        received += len(line)
+        if received > max_bytes:
+            raise _response_too_large(max_bytes)
+        if not line.strip():
+            continue
+        chunk = _json_loads(line)
+        if "error" in chunk:
+            logger.error("Error de Ollama: %s", chunk['error'])
+            raise ValueError(f"Error de Ollama: {chunk['error']}")
+        token = chunk.get("response")
+        if token:
+            parts.append(token)
+            on_token(token)
+        if chunk.get("done"):
+            break
+    return "".join(parts)
+
+
+async def _read_sse_stream(resp: aiohttp.ClientResponse, on_token: Callable[[str], Any], max_bytes: int) -> str:
+    """
+    Lee una respuesta en streaming con formato OpenAI (Server-Sent Events: líneas
+    "data: {...}" terminadas con "data: [DONE]"), pasando cada fragmento a on_token.
+    Devuelve el texto completo.
+    """
+    parts = []
+    received = 0
+    async for line in resp.content:
+        received += len(line)
+        if received > max_bytes:
+            raise _response_too_large(max_bytes)
+        line = line.strip()
+        if not line.startswith(b"data:"):
+            continue # Empty keep-alive lines, comments, "event:" fields...
+        data = line[len(b"data:"):].strip()
+        if data == b"[DONE]":
+            break
+        chunk = _json_loads(data)
+        choices = chunk.get("choices")
+        token = choices[0].get("delta", {}).get("content") if choices else None
+        if token:
+            parts.append(token)
+            on_token(token)
+    return "".join(parts)
+
+@functools.lru_cache(maxsize=8)
+def _groq_headers(api_key: str) -> Dict[str, str]:
+    """
+    Cabeceras de Groq por API key, construidas una sola vez. No modificar el dict devuelto.
+    """
+    return {"Authorization": f"Bearer {api_key}"}
+
+
+async def _load_image(imagen: str) -> str:
+    """
+    Lee la imagen en base64 para adjuntarla a la consulta, registrando los errores de archivo.
+    """
+    try:
+        return await _read_b64(imagen)
+    except FileNotFoundError:
+        logger.error("Error: Archivo de imagen no encontrado en %s", imagen)
+        raise FileNotFoundError(f"Archivo de imagen no encontrado: {imagen}")
+    except Exception as img_err:
+        logger.error("Error al procesar imagen %s: %s", imagen, img_err)
+        raise img_err
+
+
+def _mime_for(img_base64: str) -> str:
+    """
+    Detecta el tipo MIME de una imagen por sus bytes mágicos. Decodifica solo los primeros
+    16 caracteres base64 (12 bytes), así que no vuelve a leer el archivo.
+    """
+    try:
+        header = binascii.a2b_base64(img_base64[:16])
+    except ValueError: # binascii.Error, or non-ASCII characters
+        # Best-effort check only (short or malformed input, e.g. a data URI): never fail the query for it
+        return "image/jpeg"
+    if header.startswith(b"\x89PNG"):
+        return "image/png"
+    if header.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if header.startswith(b"GIF8"):
+        return "image/gif"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    return "image/jpeg" # Unknown format: keep the previous default
+
+
+def _openai_message_content(prompt: str, img_base64: Optional[str]) -> Union[str, List[Dict[str, Any]]]:
+    """
+    Contenido del mensaje de usuario en formato OpenAI: texto simple, o lista texto + imagen
+    si se adjunta una.
+    """
+    if not img_base64:
+        return prompt # If no image, use the simple string content format
+    return [
+        {"type": "text", "text": prompt},
+        # Correct format for multimodal GPT-4 Turbo / GPT-4o
+        {
+            "type": "image_url",
+            "image_url": {
+                "url": f"data:{_mime_for(img_base64)};base64,{img_base64}"
+            }
+        },
+    ]
+
+
+async def _call_ollama(
+    prompt: str,
+    modelo: Optional[str],
+    temperatura: float,
+    api_key: Optional[str],
+    url_base: Optional[str],
+    imagen: Optional[str],
+    img_base64: Optional[str],
+    timeout: int,
+    session: aiohttp.ClientSession,
+    on_token: Optional[Callable[[str], Any]],
+    max_response_bytes: int
+    ) -> str:
+    """
+    Un intento de consulta a Ollama (POST /api/generate). Los reintentos los gestiona consultar_llm_async.
+    """
+    effective_url_base = url_base or "http://localhost:11434"
+    effective_modelo = modelo or "llama3"
+    logger.info("Usando Ollama: modelo=%s, url=%s", effective_modelo, effective_url_base)
+
+    payload = {"model": effective_modelo, "prompt": prompt, "temperature": temperatura, "stream": on_token is not None}
+
+    if img_base64:
+        payload["images"] = [img_base64]
+        logger.info("Imagen %s adjuntada para Ollama.", imagen)
+
+    # Ollama generate endpoint is POST /api/generate
+    if _unix_socket_path(effective_url_base):
+        api_url = "http://localhost/api/generate" # Host is ignored; the session's connector targets the socket
+    else:
+        api_url = f"{effective_url_base.rstrip('/')}/api/generate"
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Ollama request payload: %s", _truncate_for_log(payload))
+    async with session.post(api_url, data=_json_body(payload), timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        await _raise_for_ollama_status(resp, max_response_bytes) # 4xx/5xx, with Ollama's own error text
+        if on_token is not None:
+            return (await _read_ollama_stream(resp, on_token, max_response_bytes)).strip()
+        data = _json_loads(await _read_body(resp, max_response_bytes))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Ollama raw response: %s", _truncate_for_log(data))
+        if "response" not in data:
+             # Handle potential error structure from Ollama
+             error_msg = data.get("error", "Respuesta inesperada de Ollama sin campo 'response'")
+             logger.error("Error de Ollama: %s", error_msg)
+             raise ValueError(f"Error de Ollama: {error_msg}")
+        return data["response"].strip()
+
+
+async def _call_groq(
+    prompt: str,
+    modelo: Optional[str],
+    temperatura: float,
+    api_key: Optional[str],
+    url_base: Optional[str],
+    imagen: Optional[str],
+    img_base64: Optional[str],
+    timeout: int,
+    session: aiohttp.ClientSession,
+    on_token: Optional[Callable[[str], Any]],
+    max_response_bytes: int
+    ) -> str:
+    """
+    Un intento de consulta a Groq (API compatible con OpenAI). Los reintentos los gestiona consultar_llm_async.
+    """
+    if not api_key:
+        raise ValueError("Se requiere API Key para Groq")
+
+    effective_modelo = modelo or "llama3-8b-8192" # Use a common default like llama3
+    logger.info("Usando Groq: modelo=%s", effective_modelo)
+
+    headers = _groq_headers(api_key)
+
+    if imagen:
+        # Groq currently does not support images via API, log warning
+        logger.warning("Proveedor 'groq' no soporta imágenes actualmente. La imagen '%s' será ignorada.", imagen)
+        # Do not add image data to the payload
+
+    payload = {
+        "model": effective_modelo,
+        "messages": [{"role": "user", "content": prompt}], # Groq expects simple text content here
+        "temperature": temperatura,
+        "stream": on_token is not None,
+    }
+
+    api_url = "https://api.groq.com/openai/v1/chat/completions"
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Groq request payload: %s", _truncate_for_log(payload))
+    async with session.post(api_url, data=_json_body(payload), headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as resp:
+        resp.raise_for_status()
+        if on_token is not None:
+            return (await _read_sse_stream(resp, on_token, max_response_bytes)).strip()
+        data = _json_loads(await _read_body(resp, max_response_bytes))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Groq raw response: %s", _truncate_for_log(data))
+        if not data.get("choices"):
+            error_msg = data.get("error", {}).get("message", "Respuesta inesperada de Groq sin 'choices'")
+            logger.error("Error de Groq: %s", error_msg)
+            raise ValueError(f"Error de Groq: {error_msg}")
+        return data["choices"][0]["message"]["content"].strip()
+
+
 # --- IMPORTANT ---
 # The OpenAI call below uses syntax for openai < 1.0.0
 # If you install openai >= 1.0.0, you MUST refactor this part.
 # Example refactor for OpenAI >= 1.0.0 is commented out below the original.
 
+async def _call_openai(
+    prompt: str,
+    modelo: Optional[str],
+    temperatura: float,
+    api_key: Optional[str],
+    url_base: Optional[str],
+    imagen: Optional[str],
+    img_base64: Optional[str],
+    timeout: int,
+    session: aiohttp.ClientSession,
+    on_token: Optional[Callable[[str], Any]],
+    max_response_bytes: int
+    ) -> str:
+    """
+    Un intento de consulta a OpenAI (SDK openai < 1.0). Los reintentos los gestiona consultar_llm_async.
+    """
+    if not api_key:
+        raise ValueError("Se requiere API Key para OpenAI")
+
+    # === Código para openai < 1.0.0 ===
+    try:
+        import openai # Imported on first use: make sure this matches the version dependency in pyproject.toml
+    except ImportError as e:
+        raise ImportError("El SDK de OpenAI no está instalado (pip install 'openai<1.0')") from e
+    effective_modelo = modelo or "gpt-4o" # Use gpt-4o as a modern default
+    logger.info("Usando OpenAI: modelo=%s", effective_modelo)
+
+    if img_base64:
+        logger.info("Imagen %s adjuntada para OpenAI.", imagen)
+
+    messages = [{"role": "user", "content": _openai_message_content(prompt, img_base64)}]
+
+    if logger.isEnabledFor(logging.DEBUG): # Avoid building the truncated copy when debug is off
+        logger.debug("OpenAI request messages (content truncated if long): %s", _truncate_for_log(messages))
+
+    # Route the SDK through the shared session so OpenAI calls reuse keep-alive connections too
+    # (openai < 1.0 otherwise opens a new aiohttp session per request)
+    session_token = openai.aiosession.set(session)
+    try:
+        # Using the older <1.0.0 async call
+        chat_completion = await openai.ChatCompletion.acreate(
+            model=effective_modelo,
+            messages=messages,
+            temperature=temperatura,
+            api_key=api_key, # Per call, instead of mutating the global openai.api_key
+            # max_tokens=1024, # Optional: limit response length
+            timeout=timeout, # Pass timeout to the API call if supported
+            stream=on_token is not None
+        )
+    finally:
+        openai.aiosession.reset(session_token)
+    if on_token is not None:
+        # With stream=True acreate returns an async generator of delta chunks
+        parts = []
+        async for chunk in chat_completion:
+            token = chunk.choices[0].delta.get("content") if chunk.choices else None
+            if token:
+                parts.append(token)
+                on_token(token)
+        return "".join(parts).strip()
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("OpenAI raw response: %s", _truncate_for_log(chat_completion))
+    if not chat_completion.choices:
+        logger.error("Respuesta inesperada de OpenAI sin 'choices'")
+        raise ValueError("Respuesta inesperada de OpenAI sin 'choices'")
+    return chat_completion.choices[0].message['content'].strip() # Access content correctly
+
+    # === FIN Código para openai < 1.0.0 ===
+
+    # === Código para openai >= 1.0.0 (REFACTOR - uncomment y reemplaza lo anterior si usas >=1.0) ===
+    # from openai import AsyncOpenAI # Import at top
+    # client = AsyncOpenAI(api_key=api_key, timeout=timeout)
+    # effective_modelo = modelo or "gpt-4o"
+    # logger.info(f"Usando OpenAI (>=1.0): modelo={effective_modelo}")
+    #
+    # message_content = []
+    # message_content.append({"type": "text", "text": prompt})
+    #
+    # if imagen:
+    #     try:
+    #         with open(imagen, "rb") as f:
+    #              img_base64 = base64.b64encode(f.read()).decode('utf-8')
+    #         # Correct format for multimodal GPT-4 Turbo / GPT-4o
+    #         message_content.append({
+    #              "type": "image_url",
+    #              "image_url": {
+    #                  # OpenAI prefers direct base64 for clarity
+    #                  "url": f"data:image/jpeg;base64,{img_base64}" # Or detect image type
+    #              }
+    #         })
+    #         logger.info(f"Imagen {imagen} adjuntada para OpenAI.")
+    #     except FileNotFoundError:
+    #          logger.error(f"Error: Archivo de imagen no encontrado en {imagen}")
+    #          raise FileNotFoundError(f"Archivo de imagen no encontrado: {imagen}")
+    #     except Exception as img_err:
+    #          logger.error(f"Error al procesar imagen {imagen}: {img_err}")
+    #          raise img_err
+    #
+    # messages = [{"role": "user", "content": message_content}]
+    #
+    # logger.debug(f"OpenAI request messages (content truncated if long): {[{'role': m['role'], 'content': str(m['content'])[:100]+'...' if isinstance(m['content'], list) else m['content']} for m in messages]}")
+    #
+    # chat_completion = await client.chat.completions.create(
+    #     model=effective_modelo,
+    #     messages=messages,
+    #     temperature=temperatura,
+    #     # max_tokens=1024, # Optional
+    # )
+    # logger.debug(f"OpenAI raw response: {chat_completion}")
+    # if not chat_completion.choices:
+    #      logger.error("Respuesta inesperada de OpenAI sin 'choices'")
+    #      raise ValueError("Respuesta inesperada de OpenAI sin 'choices'")
+    # return chat_completion.choices[0].message.content.strip()
+    # === FIN Código para openai >= 1.0.0 ===
+
+
+# Provider dispatch: each handler performs a single attempt; retries live in consultar_llm_async
+_PROVIDERS: Dict[str, Callable[..., Awaitable[str]]] = {
+    "ollama": _call_ollama,
+    "groq": _call_groq,
+    "openai": _call_openai,
+}
+_MULTIMODAL_PROVIDERS = {"ollama", "openai"} # Providers that receive the image (Groq ignores it)
+
+
 async def consultar_llm_async(
     prompt: str,
     proveedor: str,
@@ -22,7 +683,11 @@ async def consultar_llm_async(
     api_key: Optional[str] = None,
     url_base: Optional[str] = None,
     imagen: Optional[str] = None,
-    timeout: int = 30
+    imagen_b64: Optional[str] = None,
+    timeout: int = 30,
+    on_token: Optional[Callable[[str], Any]] = None,
+    session: Optional[aiohttp.ClientSession] = None,
+    max_response_bytes: int = 16 * 1024 * 1024
     ) -> str:
     """
     Consulta un LLM de varios proveedores de forma asíncrona, soportando texto e imágenes.
@@ -32,233 +697,118 @@ async def consultar_llm_async(
     :param modelo: Modelo a usar (opcional)
     :param temperatura: Creatividad de la respuesta
     :param api_key: Clave de API si aplica
-    :param url_base: URL base para Ollama si aplica (default: http://localhost:11434)
+    :param url_base: URL base para Ollama si aplica (default: http://localhost:11434).
+        Admite un socket Unix local con la forma unix:///ruta/al/ollama.sock
     :param imagen: Ruta local a imagen para consultas multimodales
+    :param imagen_b64: Imagen ya codificada en base64 (p.ej. la misma imagen enviada a varios
+        proveedores). Si se indica, se usa en lugar de leer `imagen`, que queda solo como etiqueta en los logs
     :param timeout: Tiempo máximo de espera por consulta (en segundos)
-    :return: Respuesta generada
+    :param on_token: Callback opcional. Si se indica, la respuesta se recibe en streaming y
+        se llama con cada fragmento de texto según llega (si un intento falla a mitad, el
+        reintento vuelve a emitir desde el principio)
+    :param session: Sesión aiohttp a usar en lugar de las compartidas del módulo (ver AausLLM).
+        Se ignora para Ollama por socket Unix, que usa su propia sesión.
+    :param max_response_bytes: Tamaño máximo de la respuesta de Ollama/Groq (en bytes; en
+        streaming, acumulado). Si se supera se lanza ValueError sin reintentar (default: 16 MiB)
+    :return: Respuesta generada (completa, también en modo streaming)
     :raises ValueError: Si el proveedor no es soportado o falta API Key.
     :raises Exception: Si la consulta falla después de los reintentos.
     """
     retries = 3
-    delay = 2  # segundos entre reintentos
+    base_delay = 1.0   # segundos antes del primer reintento
+    max_delay = 30.0   # tope del backoff exponencial
+
+    handler = _PROVIDERS.get(proveedor)
+    if handler is None:
+        error_msg = f"Proveedor '{proveedor}' no soportado. Use 'ollama', 'groq' o 'openai'."
+        logger.error("Error de configuración para %s: %s", proveedor, error_msg)
+        raise ValueError(error_msg)
+
+    unix_path = _unix_socket_path(url_base) if proveedor == "ollama" else None
+
+    # Read and encode the image once, not on every retry attempt
+    if imagen_b64 and not imagen:
+        imagen = "<imagen_b64>" # Label for logs and warnings
+    img_base64 = None
+    if proveedor in _MULTIMODAL_PROVIDERS:
+        if imagen_b64:
+            img_base64 = imagen_b64
+        elif imagen:
+            img_base64 = await _load_image(imagen)
 
     for intento in range(retries):
         try:
-            logger.info(f"Intento {intento+1}/{retries} para proveedor '{proveedor}' con prompt: '{prompt[:50]}...'")
-
-            if proveedor == "ollama":
-                effective_url_base = url_base or "http://localhost:11434"
-                effective_modelo = modelo or "llama3"
-                logger.info(f"Usando Ollama: modelo={effective_modelo}, url={effective_url_base}")
-
-                payload = {"model": effective_modelo, "prompt": prompt, "temperature": temperatura, "stream": False} # Ensure stream is False
-
-                if imagen:
-                    try:
-                        with open(imagen, "rb") as f:
-                            img_base64 = base64.b64encode(f.read()).decode('utf-8')
-                        payload["images"] = [img_base64]
-                        logger.info(f"Imagen {imagen} adjuntada para Ollama.")
-                    except FileNotFoundError:
-                        logger.error(f"Error: Archivo de imagen no encontrado en {imagen}")
-                        raise FileNotFoundError(f"Archivo de imagen no encontrado: {imagen}")
-                    except Exception as img_err:
-                        logger.error(f"Error al procesar imagen {imagen}: {img_err}")
-                        raise img_err
-
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-                    # Ollama generate endpoint is POST /api/generate
-                    api_url = f"{effective_url_base.rstrip('/')}/api/generate"
-                    logger.debug(f"Ollama request payload: {payload}")
-                    async with session.post(api_url, json=payload) as resp:
-                        resp.raise_for_status() # Raise exception for bad status codes (4xx or 5xx)
-                        data = await resp.json()
-                        logger.debug(f"Ollama raw response: {data}")
-                        if "response" not in data:
-                             # Handle potential error structure from Ollama
-                             error_msg = data.get("error", "Respuesta inesperada de Ollama sin campo 'response'")
-                             logger.error(f"Error de Ollama: {error_msg}")
-                             raise ValueError(f"Error de Ollama: {error_msg}")
-                        return data["response"].strip()
-
-
-            elif proveedor == "groq":
-                if not api_key:
-                    raise ValueError("Se requiere API Key para Groq")
-
-                effective_modelo = modelo or "llama3-8b-8192" # Use a common default like llama3
-                logger.info(f"Usando Groq: modelo={effective_modelo}")
-
-                headers = {
-                    "Authorization": f"Bearer {api_key}",
-                    "Content-Type": "application/json"
-                }
-                message_content = [{"type": "text", "text": prompt}]
-
-                if imagen:
-                    # Groq currently does not support images via API, log warning
-                    logger.warning(f"Proveedor 'groq' no soporta imágenes actualmente. La imagen '{imagen}' será ignorada.")
-                    # Do not add image data to the payload
-
-                payload = {
-                    "model": effective_modelo,
-                    "messages": [{"role": "user", "content": message_content[0]['text']}], # Groq expects simple text content here
-                    "temperature": temperatura,
-                    "stream": False,
-                }
-
-                api_url = "https://api.groq.com/openai/v1/chat/completions"
-
-                async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-                    logger.debug(f"Groq request payload: {payload}")
-                    async with session.post(api_url, json=payload) as resp:
-                        resp.raise_for_status()
-                        data = await resp.json()
-                        logger.debug(f"Groq raw response: {data}")
-                        if not data.get("choices"):
-                            error_msg = data.get("error", {}).get("message", "Respuesta inesperada de Groq sin 'choices'")
-                            logger.error(f"Error de Groq: {error_msg}")
-                            raise ValueError(f"Error de Groq: {error_msg}")
-                        return data["choices"][0]["message"]["content"].strip()
-
-
-            elif proveedor == "openai":
-                if not api_key:
-                    raise ValueError("Se requiere API Key para OpenAI")
-
-                # === Código para openai < 1.0.0 ===
-                openai.api_key = api_key
-                effective_modelo = modelo or "gpt-4o" # Use gpt-4o as a modern default
-                logger.info(f"Usando OpenAI: modelo={effective_modelo}")
-
-                message_content = []
-                message_content.append({"type": "text", "text": prompt})
-
-                if imagen:
-                    try:
-                        with open(imagen, "rb") as f:
-                            img_base64 = base64.b64encode(f.read()).decode('utf-8')
-                        # Correct format for multimodal GPT-4 Turbo / GPT-4o
-                        message_content.append({
-                             "type": "image_url",
-                             "image_url": {
-                                 "url": f"data:image/jpeg;base64,{img_base64}" # Assuming jpeg/png common formats
-                             }
-                        })
-                        logger.info(f"Imagen {imagen} adjuntada para OpenAI.")
-                    except FileNotFoundError:
-                         logger.error(f"Error: Archivo de imagen no encontrado en {imagen}")
-                         raise FileNotFoundError(f"Archivo de imagen no encontrado: {imagen}")
-                    except Exception as img_err:
-                         logger.error(f"Error al procesar imagen {imagen}: {img_err}")
-                         raise img_err
-                else:
-                     # If no image, use the simple string content format
-                     message_content = prompt # Override list format
-
-                messages = [{"role": "user", "content": message_content}]
-
-                logger.debug(f"OpenAI request messages (content truncated if long): {[{'role': m['role'], 'content': str(m['content'])[:100]+'...' if isinstance(m['content'], str) and len(m['content'])>100 else m['content']} for m in messages]}")
-
-                # Using the older <1.0.0 async call
-                chat_completion = await openai.ChatCompletion.acreate(
-                    model=effective_modelo,
-                    messages=messages,
-                    temperature=temperatura,
-                    # max_tokens=1024, # Optional: limit response length
-                    timeout=timeout # Pass timeout to the API call if supported
+            logger.info("Intento %s/%s para proveedor '%s' con prompt: '%s...'", intento+1, retries, proveedor, prompt[:50])
+
+            async with _get_semaphore(proveedor):
+                request_session = session if session is not None and not unix_path else await _get_session(proveedor, unix_path)
+                return await handler(
+                    prompt=prompt,
+                    modelo=modelo,
+                    temperatura=temperatura,
+                    api_key=api_key,
+                    url_base=url_base,
+                    imagen=imagen,
+                    img_base64=img_base64,
+                    timeout=timeout,
+                    session=request_session,
+                    on_token=on_token,
+                    max_response_bytes=max_response_bytes
                 )
-                logger.debug(f"OpenAI raw response: {chat_completion}")
-                if not chat_completion.choices:
-                    logger.error("Respuesta inesperada de OpenAI sin 'choices'")
-                    raise ValueError("Respuesta inesperada de OpenAI sin 'choices'")
-                return chat_completion.choices[0].message['content'].strip() # Access content correctly
-
-                # === FIN Código para openai < 1.0.0 ===
-
-                # === Código para openai >= 1.0.0 (REFACTOR - uncomment y reemplaza lo anterior si usas >=1.0) ===
-                # from openai import AsyncOpenAI # Import at top
-                # client = AsyncOpenAI(api_key=api_key, timeout=timeout)
-                # effective_modelo = modelo or "gpt-4o"
-                # logger.info(f"Usando OpenAI (>=1.0): modelo={effective_modelo}")
-                #
-                # message_content = []
-                # message_content.append({"type": "text", "text": prompt})
-                #
-                # if imagen:
-                #     try:
-                #         with open(imagen, "rb") as f:
-                #              img_base64 = base64.b64encode(f.read()).decode('utf-8')
-                #         # Correct format for multimodal GPT-4 Turbo / GPT-4o
-                #         message_content.append({
-                #              "type": "image_url",
-                #              "image_url": {
-                #                  # OpenAI prefers direct base64 for clarity
-                #                  "url": f"data:image/jpeg;base64,{img_base64}" # Or detect image type
-                #              }
-                #         })
-                #         logger.info(f"Imagen {imagen} adjuntada para OpenAI.")
-                #     except FileNotFoundError:
-                #          logger.error(f"Error: Archivo de imagen no encontrado en {imagen}")
-                #          raise FileNotFoundError(f"Archivo de imagen no encontrado: {imagen}")
-                #     except Exception as img_err:
-                #          logger.error(f"Error al procesar imagen {imagen}: {img_err}")
-                #          raise img_err
-                #
-                # messages = [{"role": "user", "content": message_content}]
-                #
-                # logger.debug(f"OpenAI request messages (content truncated if long): {[{'role': m['role'], 'content': str(m['content'])[:100]+'...' if isinstance(m['content'], list) else m['content']} for m in messages]}")
-                #
-                # chat_completion = await client.chat.completions.create(
-                #     model=effective_modelo,
-                #     messages=messages,
-                #     temperature=temperatura,
-                #     # max_tokens=1024, # Optional
-                # )
-                # logger.debug(f"OpenAI raw response: {chat_completion}")
-                # if not chat_completion.choices:
-                #      logger.error("Respuesta inesperada de OpenAI sin 'choices'")
-                #      raise ValueError("Respuesta inesperada de OpenAI sin 'choices'")
-                # return chat_completion.choices[0].message.content.strip()
-                # === FIN Código para openai >= 1.0.0 ===
-
-            else:
-                raise ValueError(f"Proveedor '{proveedor}' no soportado. Use 'ollama', 'groq' o 'openai'.")
-
-        except aiohttp.ClientResponseError as http_err:
-            logger.error(f"Error HTTP en intento {intento+1}/{retries} para {proveedor}: {http_err.status} {http_err.message}")
-            # Log response body if available for debugging
-            try:
-                error_body = await http_err.response.text()
-                logger.error(f"Error Body: {error_body[:500]}") # Log first 500 chars
-            except Exception:
-                 logger.error("No se pudo leer el cuerpo del error HTTP.")
-
-            if intento < retries - 1:
-                logger.info(f"Reintentando en {delay} segundos...")
-                await asyncio.sleep(delay)
-            else:
-                logger.error(f"Falló después de {retries} intentos para {proveedor}.")
-                raise http_err # Re-raise the final HTTP error
-        except aiohttp.ClientError as client_err: # Includes connection errors, timeouts
-             logger.error(f"Error de Cliente/Red en intento {intento+1}/{retries} para {proveedor}: {client_err}")
-             if intento < retries - 1:
-                 logger.info(f"Reintentando en {delay} segundos...")
-                 await asyncio.sleep(delay)
-             else:
-                 logger.error(f"Falló después de {retries} intentos para {proveedor}.")
-                 raise client_err # Re-raise the final client error
-        except ValueError as val_err: # Catch specific config errors like missing API keys
-             logger.error(f"Error de configuración para {proveedor}: {val_err}")
-             raise val_err # Do not retry configuration errors
-        except FileNotFoundError as fnf_err: # Catch file not found for images
-            logger.error(f"Error de archivo: {fnf_err}")
-            raise fnf_err # Do not retry file not found errors
-        except Exception as e:
-            logger.error(f"Error inesperado en intento {intento+1}/{retries} para {proveedor}: {e.__class__.__name__}: {e}")
-            if intento < retries - 1:
-                logger.info(f"Reintentando en {delay} segundos...")
-                await asyncio.sleep(delay)
-            else:
-                logger.error(f"Falló después de {retries} intentos para {proveedor}.")
-                raise e # Re-raise the final unexpected error
\ No newline at end of file
+
+        except Exception as err:
+            if not _is_retryable(err):
+                # Configuration errors (missing API key, bad provider), missing image files, 4xx,
+                # malformed responses or bugs: retrying will not change the outcome
+                logger.error("Error no recuperable para %s: %s: %s", proveedor, err.__class__.__name__, err)
+                raise
+            logger.error("Error en intento %s/%s para %s: %s: %s", intento+1, retries, proveedor, err.__class__.__name__, err)
+            if intento == retries - 1:
+                logger.error("Falló después de %s intentos para %s.", retries, proveedor)
+                raise
+            delay = _backoff_delay(intento, base_delay, max_delay)
+            retry_after = _retry_after(err)
+            if retry_after is not None:
+                # Waiting less than the server asked for would most likely hit the rate limit again
+                delay = max(delay, min(retry_after, max_delay))
+            logger.info("Reintentando en %.2f segundos...", delay)
+            await asyncio.sleep(delay)
+
+
+class AausLLM:
+    """
+    Cliente con un pool de conexiones propio, pensado para usarse como context manager:
+
+        async with AausLLM() as llm:
+            respuestas = await asyncio.gather(
+                llm.consultar("Hola", proveedor="ollama"),
+                llm.consultar("Hola", proveedor="groq", api_key=groq_key),
+            )
+
+    Todas las consultas hechas con el cliente (todos los proveedores) comparten la misma
+    sesión HTTP, que se cierra al salir del bloque.
+
+    :param session: Sesión aiohttp ya creada por la aplicación (p.ej. con un TCPConnector
+        ajustado). Si se indica, el cliente la usa pero no la cierra.
+    """
+
+    def __init__(self, session: Optional[aiohttp.ClientSession] = None) -> None:
+        self._session = session
+        self._owns_session = session is None
+
+    async def __aenter__(self) -> "AausLLM":
+        if self._owns_session:
+            self._session = aiohttp.ClientSession(connector=_new_connector())
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        if self._owns_session and self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def consultar(self, prompt: str, proveedor: str, **kwargs: Any) -> str:
+        """
+        Igual que consultar_llm_async (mismos parámetros), usando la sesión del cliente.
+        Fuera del bloque async with usa las sesiones compartidas del módulo.
+        """
+        return await consultar_llm_async(prompt, proveedor, session=self._session, **kwargs)
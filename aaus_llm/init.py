@@ -1 +0,0 @@
-from .cliente import consultar_llm_async
\ No newline at end of file
@@ -1,27 +1,68 @@
+import argparse
 import asyncio
+import atexit
+import base64
+import hashlib
 import os
 import logging
+import logging.handlers
+import queue
+import sys
+import time
 import aiohttp # Import needed for specific error handling
 
+try:
+    import orjson # Optional: pip install orjson (included in aaus_llm[fast])
+    def _json_dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+    _json_dumps = json.dumps
+
+# Configure logging for the example. Records go through a queue and are written to stderr by a
+# listener thread, so printing long LLM responses never blocks the event loop.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_handler)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
+_log_listener.start()
+atexit.register(_log_listener.stop) # Flushes pending records on exit
+
+logger = logging.getLogger(__name__)
+
 # --- Load environment variables from .env file ---
 # Needs: pip install python-dotenv
-from dotenv import load_dotenv
-load_dotenv() # Looks for .env in the current dir or parent dirs
+# Set AAUS_SKIP_DOTENV=1 when the whole configuration already comes from the environment (docker,
+# CI, systemd): saves importing python-dotenv and scanning the parent directories for a .env file.
+if not os.environ.get("AAUS_SKIP_DOTENV"):
+    from dotenv import load_dotenv
+    load_dotenv() # Looks for .env in the current dir or parent dirs
 # --- END Load environment variables ---
 
-# Import the function from the installed package
+# Import the client from the installed package
 # Needs: pip install . (or -e .) from the package root directory
-try:
-    from aaus_llm import consultar_llm_async
-except ImportError:
-    logging.error("Failed to import aaus_llm. Make sure it's installed (pip install .)")
-    # Provide a dummy function to avoid crashing later if import failed
-    async def consultar_llm_async(*args, **kwargs):
-        raise ImportError("aaus_llm package not found or not installed.")
+class AausNoInstalado(ImportError):
+    """Raised by the stub client below, so it is not confused with a dependency missing inside aaus_llm."""
 
 
-# Configure logging for the example
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+try:
+    from aaus_llm import AausLLM, configure
+except ImportError:
+    logger.error("Failed to import aaus_llm. Make sure it's installed (pip install .)")
+    # Provide a dummy client to avoid crashing later if import failed
+    class AausLLM:
+        def __init__(self, session=None):
+            pass
+        async def __aenter__(self):
+            return self
+        async def __aexit__(self, *exc_info):
+            pass
+        async def consultar(self, *args, **kwargs):
+            raise AausNoInstalado("aaus_llm package not found or not installed.")
+    def configure(**kwargs):
+        pass
 
 # --- CONFIGURATION (Now loaded from .env or system environment) ---
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY") # No default needed, check later
@@ -30,186 +71,399 @@ GROQ_API_KEY = os.environ.get("GROQ_API_KEY")     # No default needed, check lat
 # Load image path from .env or use a default/None
 DEFAULT_IMAGE_PATH = "image_not_set.jpg" # Or set to None if you prefer
 IMAGE_PATH = os.environ.get("IMAGE_PATH", DEFAULT_IMAGE_PATH)
+IMAGE_EXISTS = bool(IMAGE_PATH) and os.path.exists(IMAGE_PATH) # One stat() for the whole run
 
 # Load Ollama URL from .env or use default
 OLLAMA_BASE_URL = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434")
 
+# Optional per-provider caps on requests in flight (e.g. AAUS_MAX_CONCURRENCY_GROQ=16).
+# aaus_llm already queues requests above its defaults (openai=20, groq=10, ollama=4), so a
+# large fan-out waits locally instead of hitting rate limits (429); raise or lower them here.
+MAX_CONCURRENCY = {
+    proveedor: int(os.environ[f"AAUS_MAX_CONCURRENCY_{proveedor.upper()}"])
+    for proveedor in ("openai", "groq", "ollama")
+    if os.environ.get(f"AAUS_MAX_CONCURRENCY_{proveedor.upper()}")
+}
+
+# Size of the example's connection pool (aiohttp's default is 100 connections in total).
+# Raise them when scaling the example up to thousands of concurrent calls; 0 means no limit.
+POOL_LIMIT = int(os.environ.get("AAUS_POOL_LIMIT", "200"))
+POOL_PER_HOST = int(os.environ.get("AAUS_POOL_PER_HOST", "64"))
+
 # Check if keys/paths seem valid
 if not OPENAI_API_KEY:
-    logging.warning("OPENAI_API_KEY not found in environment or .env file. OpenAI examples will fail.")
+    logger.warning("OPENAI_API_KEY not found in environment or .env file. OpenAI examples will fail.")
 if not GROQ_API_KEY:
-    logging.warning("GROQ_API_KEY not found in environment or .env file. Groq examples will fail.")
+    logger.warning("GROQ_API_KEY not found in environment or .env file. Groq examples will fail.")
 if IMAGE_PATH == DEFAULT_IMAGE_PATH:
-     logging.warning(f"IMAGE_PATH not found in environment or .env file, using default: '{DEFAULT_IMAGE_PATH}'. Multimodal examples might fail if this file doesn't exist.")
-elif not os.path.exists(IMAGE_PATH):
-     logging.warning(f"IMAGE_PATH is set to '{IMAGE_PATH}', but the file does not exist. Multimodal examples will fail.")
+     logger.warning("IMAGE_PATH not found in environment or .env file, using default: '%s'. Multimodal examples might fail if this file doesn't exist.", DEFAULT_IMAGE_PATH)
+elif not IMAGE_EXISTS:
+     logger.warning("IMAGE_PATH is set to '%s', but the file does not exist. Multimodal examples will fail.", IMAGE_PATH)
 
 # --- END CONFIGURATION ---
 
 
-async def ejemplo_openai_texto():
-    logging.info("\n--- Ejemplo OpenAI (Texto) ---")
-    if not OPENAI_API_KEY:
-        logging.warning("Skipping OpenAI Text: API Key missing.")
-        return "Skipped: OpenAI Key missing"
-    try:
-        respuesta = await consultar_llm_async(
-            prompt="¿Quién fue Marie Curie y cuáles fueron sus principales contribuciones?",
-            proveedor="openai",
-            modelo="gpt-4o",
-            api_key=OPENAI_API_KEY,
-            temperatura=0.5
-        )
-        logging.info(f"Respuesta OpenAI (Texto):\n{respuesta}")
-        return respuesta
-    except ImportError:
-         logging.error("Skipping OpenAI Text: aaus_llm not installed.")
-         return "Skipped: aaus_llm not installed."
-    except Exception as e:
-        logging.error(f"Error en ejemplo OpenAI (Texto): {e}")
-        return f"Error: {e}"
+def _read_image_b64(path):
+    with open(path, "rb") as f:
+        datos = f.read()
+    return base64.b64encode(datos).decode("ascii"), hashlib.sha1(datos).hexdigest()
 
-async def ejemplo_openai_multimodal():
-    logging.info("\n--- Ejemplo OpenAI (Multimodal) ---")
-    if not OPENAI_API_KEY:
-        logging.warning("Skipping OpenAI Multimodal: API Key missing.")
-        return "Skipped: OpenAI Key missing"
-    if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
-        logging.warning(f"Skipping OpenAI Multimodal: Imagen no encontrada o no configurada ('{IMAGE_PATH}')")
-        return f"Skipped: Image not found at '{IMAGE_PATH}'"
-    try:
-        respuesta = await consultar_llm_async(
-            prompt="Describe detalladamente qué ves en esta imagen.",
-            proveedor="openai",
-            modelo="gpt-4o",
-            api_key=OPENAI_API_KEY,
-            imagen=IMAGE_PATH
-        )
-        logging.info(f"Respuesta OpenAI (Multimodal):\n{respuesta}")
-        return respuesta
-    except ImportError:
-         logging.error("Skipping OpenAI Multimodal: aaus_llm not installed.")
-         return "Skipped: aaus_llm not installed."
-    except Exception as e:
-        logging.error(f"Error en ejemplo OpenAI (Multimodal): {e}")
-        return f"Error: {e}"
 
-async def ejemplo_groq_texto():
-    logging.info("\n--- Ejemplo Groq (Texto) ---")
-    if not GROQ_API_KEY:
-        logging.warning("Skipping Groq Text: API Key missing.")
-        return "Skipped: Groq Key missing"
-    try:
-        respuesta = await consultar_llm_async(
-            prompt="Explica el concepto de 'cloud computing' de forma sencilla usando una analogía.",
-            proveedor="groq",
-            modelo="llama3-8b-8192",
-            api_key=GROQ_API_KEY
-        )
-        logging.info(f"Respuesta Groq (Texto):\n{respuesta}")
-        return respuesta
-    except ImportError:
-         logging.error("Skipping Groq Text: aaus_llm not installed.")
-         return "Skipped: aaus_llm not installed."
-    except Exception as e:
-        logging.error(f"Error en ejemplo Groq (Texto): {e}")
-        return f"Error: {e}"
+def _olvidar_si_falla(cache, clave):
+    """Done-callback that drops a failed or cancelled future from the cache, so the next call retries."""
+    def callback(futuro):
+        if (futuro.cancelled() or futuro.exception() is not None) and cache.get(clave) is futuro:
+            del cache[clave]
+    return callback
+
+
+_image_cache = {} # path -> future with (base64 string, sha1 of the file)
+
 
-async def ejemplo_ollama_texto():
-    logging.info("\n--- Ejemplo Ollama (Texto Local) ---")
+async def _load_image(path):
+    # Read, encode and hash the image once, in a worker thread so the disk read does not stall the
+    # other requests in flight; concurrent multimodal examples await the same future
+    futuro = _image_cache.get(path)
+    if futuro is None or (not futuro.done() and futuro.get_loop() is not asyncio.get_running_loop()):
+        futuro = asyncio.get_running_loop().run_in_executor(None, _read_image_b64, path)
+        futuro.add_done_callback(_olvidar_si_falla(_image_cache, path))
+        _image_cache[path] = futuro
+    return futuro.result() if futuro.done() else await futuro
+
+
+async def _load_image_b64(path):
+    return (await _load_image(path))[0]
+
+
+# Responses already obtained in this process, so running main() again (benchmarks, tests) does not
+# repeat identical requests. Set AAUS_NO_CACHE=1 to always query the providers.
+NO_CACHE = bool(os.environ.get("AAUS_NO_CACHE"))
+_response_cache = {} # (proveedor, modelo, prompt, temperatura, sha1 of the image) -> future
+_esperando = {} # in-flight future -> number of callers awaiting it
+
+
+async def consultar_cacheado(llm, **kwargs):
+    """Same as llm.consultar(**kwargs), reusing the response of an identical earlier query."""
+    if NO_CACHE:
+        return await llm.consultar(**kwargs)
+    imagen_sha1 = (await _load_image(kwargs["imagen"]))[1] if kwargs.get("imagen") else None
+    clave = (kwargs["proveedor"], kwargs.get("modelo"), kwargs["prompt"], kwargs.get("temperatura"), imagen_sha1)
+    futuro = _response_cache.get(clave)
+    if futuro is not None and futuro.done() and not futuro.cancelled() and futuro.exception() is None:
+        logger.debug("Respuesta en caché para %s/%s", kwargs["proveedor"], kwargs.get("modelo"))
+        return futuro.result()
+    if futuro is None or futuro.done() or futuro.get_loop() is not asyncio.get_running_loop():
+        # Miss, or an entry that failed/was cancelled and whose done-callback has not run yet
+        futuro = asyncio.ensure_future(llm.consultar(**kwargs))
+        futuro.add_done_callback(_olvidar_si_falla(_response_cache, clave)) # Only successes stay cached
+        _response_cache[clave] = futuro
+    _esperando[futuro] = _esperando.get(futuro, 0) + 1
     try:
-        respuesta = await consultar_llm_async(
-            prompt="¿Qué es Python y para qué se usa principalmente?",
-            proveedor="ollama",
-            modelo="llama3", # Ensure this model is pulled in Ollama
-            url_base=OLLAMA_BASE_URL
-        )
-        logging.info(f"Respuesta Ollama (Texto):\n{respuesta}")
-        return respuesta
-    except ImportError:
-         logging.error("Skipping Ollama Text: aaus_llm not installed.")
-         return "Skipped: aaus_llm not installed."
-    except Exception as e:
+        # shield: one caller giving up must not cancel the request other callers are still waiting on
+        return await asyncio.shield(futuro)
+    finally:
+        _esperando[futuro] -= 1
+        if not _esperando[futuro]:
+            del _esperando[futuro]
+            if not futuro.done():
+                futuro.cancel() # Nobody is waiting for it any more: free its connection
+
+
+API_KEYS = {"openai": OPENAI_API_KEY, "groq": GROQ_API_KEY} # Providers that need an API key
+
+
+# Hints for the HTTP statuses Ollama answers with, instead of searching the error text
+OLLAMA_ERRORES_HTTP = {
+    404: "Modelo no encontrado en Ollama. Descárgalo antes (`ollama pull llama3`, `ollama pull llava`).",
+}
+# Only for requests that send an image
+OLLAMA_ERRORES_HTTP_IMAGEN = {
+    **OLLAMA_ERRORES_HTTP,
+    400: "Ollama rechazó la petición. Las imágenes requieren Ollama >= v0.1.29 y un modelo multimodal (llava).",
+}
+
+
+def _describir_error(proveedor, e, con_imagen=False):
+    if proveedor == "ollama":
         if isinstance(e, aiohttp.ClientConnectorError):
-             logging.error(f"Error en ejemplo Ollama (Texto): No se pudo conectar a Ollama en '{OLLAMA_BASE_URL}'. ¿Está el servidor corriendo?")
-        else:
-            logging.error(f"Error en ejemplo Ollama (Texto): {e}")
-        return f"Error: {e}"
+            return f"No se pudo conectar a Ollama en '{OLLAMA_BASE_URL}'. ¿Está el servidor corriendo?"
+        pistas = OLLAMA_ERRORES_HTTP_IMAGEN if con_imagen else OLLAMA_ERRORES_HTTP
+        pista = pistas.get(getattr(e, "status", None)) # aiohttp.ClientResponseError.status
+        if pista:
+            return f"{pista} (Ollama {e.status}: {e.message})" # e.message is Ollama's own "error" text
+    return str(e)
+
+
+# The examples, as data: one runner below executes them all. Add entries (other models,
+# temperatures, prompt lengths) to compare them without writing a new function per case.
+EJEMPLOS = [
+    {
+        "nombre": "Ollama (Texto Local)",
+        "proveedor": "ollama",
+        "modelo": "llama3", # Ensure this model is pulled in Ollama
+        "prompt": "¿Qué es Python y para qué se usa principalmente?",
+    },
+    {
+        # Assumes Ollama server (>= v0.1.29) is running and has a multimodal model
+        "nombre": "Ollama (Multimodal Local)",
+        "proveedor": "ollama",
+        "modelo": "llava", # Ensure this model is pulled: ollama pull llava
+        "prompt": "Describe la imagen.",
+        "imagen": True,
+    },
+    {
+        "nombre": "OpenAI (Multimodal)",
+        "proveedor": "openai",
+        "modelo": "gpt-4o",
+        "prompt": "Describe detalladamente qué ves en esta imagen.",
+        "imagen": True,
+    },
+    {
+        "nombre": "Groq (Texto)",
+        "proveedor": "groq",
+        "modelo": "llama3-8b-8192",
+        "prompt": "Explica el concepto de 'cloud computing' de forma sencilla usando una analogía.",
+    },
+    {
+        "nombre": "OpenAI (Texto)",
+        "proveedor": "openai",
+        "modelo": "gpt-4o",
+        "prompt": "¿Quién fue Marie Curie y cuáles fueron sus principales contribuciones?",
+        "temperatura": 0.5,
+    },
+]
+
 
-async def ejemplo_ollama_multimodal():
-    logging.info("\n--- Ejemplo Ollama (Multimodal Local) ---")
-    # Assumes Ollama server (>= v0.1.29) is running and has a multimodal model
-    if not IMAGE_PATH or not os.path.exists(IMAGE_PATH):
-        logging.warning(f"Skipping Ollama Multimodal: Imagen no encontrada o no configurada ('{IMAGE_PATH}')")
-        return f"Skipped: Image not found at '{IMAGE_PATH}'"
+def _habilitado(spec):
+    """Whether the API key and image an example needs are available."""
+    proveedor = spec["proveedor"]
+    if proveedor in API_KEYS and not API_KEYS[proveedor]:
+        logger.warning("Skipping %s: API Key missing.", spec["nombre"])
+        return False
+    if spec.get("imagen") and not IMAGE_EXISTS:
+        logger.warning("Skipping %s: Imagen no encontrada o no configurada ('%s')", spec["nombre"], IMAGE_PATH)
+        return False
+    return True
+
+
+def _es_fatal(e):
+    """
+    Errors that retrying or the other examples cannot get past: TLS failures and rejected
+    credentials (401/403). They cancel the remaining examples instead of becoming a result string.
+    """
+    if isinstance(e, aiohttp.ClientSSLError): # Includes certificate errors
+        return True
+    if isinstance(e, aiohttp.ClientResponseError) and e.status in (401, 403):
+        return True
+    openai_error = getattr(sys.modules.get("openai"), "error", None) # Only imported once an OpenAI query ran
+    return openai_error is not None and isinstance(e, (openai_error.AuthenticationError, openai_error.PermissionError))
+
+
+async def ejecutar_ejemplo(spec, llm):
+    """
+    Runs one entry of EJEMPLOS: logs the answer, and turns recoverable errors into a result
+    string. Fatal ones (see _es_fatal) are raised so the parallel run cancels its siblings.
+    """
+    nombre, proveedor = spec["nombre"], spec["proveedor"]
+    logger.info("\n--- Ejemplo %s ---", nombre)
+    kwargs = {"prompt": spec["prompt"], "proveedor": proveedor, "modelo": spec.get("modelo")}
+    if "temperatura" in spec:
+        kwargs["temperatura"] = spec["temperatura"]
+    if proveedor in API_KEYS:
+        kwargs["api_key"] = API_KEYS[proveedor]
+    if proveedor == "ollama":
+        kwargs["url_base"] = OLLAMA_BASE_URL
     try:
-        respuesta = await consultar_llm_async(
-            prompt="Describe la imagen.",
-            proveedor="ollama",
-            modelo="llava", # Ensure this model is pulled: ollama pull llava
-            imagen=IMAGE_PATH,
-            url_base=OLLAMA_BASE_URL
-        )
-        logging.info(f"Respuesta Ollama (Multimodal):\n{respuesta}")
+        if spec.get("imagen"):
+            kwargs["imagen"] = IMAGE_PATH
+            kwargs["imagen_b64"] = await _load_image_b64(IMAGE_PATH)
+        respuesta = await consultar_cacheado(llm, **kwargs)
+        logger.info("Respuesta %s:\n%s", nombre, respuesta) # Lazy: not formatted if INFO is off
         return respuesta
-    except ImportError:
-         logging.error("Skipping Ollama Multimodal: aaus_llm not installed.")
-         return "Skipped: aaus_llm not installed."
+    except AausNoInstalado:
+        logger.error("Skipping %s: aaus_llm not installed.", nombre)
+        return "Skipped: aaus_llm not installed."
     except Exception as e:
-        if isinstance(e, aiohttp.ClientConnectorError):
-             logging.error(f"Error en ejemplo Ollama (Multimodal): No se pudo conectar a Ollama en '{OLLAMA_BASE_URL}'. ¿Está el servidor corriendo?")
-        elif "model not found" in str(e).lower() or ('parameters' in str(e).lower() and 'images' in str(e).lower()):
-             logging.error("Error en ejemplo Ollama (Multimodal): Modelo 'llava' no encontrado o versión de Ollama no soporta imágenes. Asegúrate de tener 'llava' (`ollama pull llava`) y Ollama >= v0.1.29.")
-        else:
-             logging.error(f"Error en ejemplo Ollama (Multimodal): {e}")
+        if _es_fatal(e):
+            logger.error("Error fatal en ejemplo %s: %s: %s", nombre, e.__class__.__name__, e)
+            raise
+        logger.error("Error en ejemplo %s: %s", nombre, _describir_error(proveedor, e, con_imagen=bool(spec.get("imagen"))))
         return f"Error: {e}"
 
 
-async def main():
-    logging.info("Ejecutando ejemplos de aaus_llm (cargando config desde .env)...")
-
-    # Run examples sequentially for clarity in logs
-    # Comment/uncomment the examples you want to run:
-    await ejemplo_ollama_texto()
-    # await ejemplo_ollama_multimodal() # Needs 'llava' model & valid IMAGE_PATH
-    # await ejemplo_groq_texto()        # Needs GROQ_API_KEY
-    # await ejemplo_openai_texto()      # Needs OPENAI_API_KEY
-    # await ejemplo_openai_multimodal() # Needs OPENAI_API_KEY & valid IMAGE_PATH
-
-
-    # Example of running them in parallel (uncomment to try)
-    # logging.info("\n--- Ejecutando tareas en paralelo ---")
-    # tareas = []
-    # if os.path.exists(IMAGE_PATH): # Only add multimodal if image exists
-    #      if OPENAI_API_KEY:
-    #         tareas.append(ejemplo_openai_multimodal())
-    #      tareas.append(ejemplo_ollama_multimodal())
-    # else:
-    #      logging.warning("Skipping parallel multimodal tasks due to missing image.")
-
-    # if OPENAI_API_KEY:
-    #     tareas.append(ejemplo_openai_texto())
-    # if GROQ_API_KEY:
-    #     tareas.append(ejemplo_groq_texto())
-    # tareas.append(ejemplo_ollama_texto())
-
-    # if tareas:
-    #      resultados = await asyncio.gather(*tareas, return_exceptions=True) # Capture exceptions too
-    #      logging.info("\n--- Resultados Paralelos ---")
-    #      for i, res in enumerate(resultados):
-    #          if isinstance(res, Exception):
-    #              logging.error(f"Tarea paralela {i+1} falló: {res}")
-    #          else:
-    #              logging.info(f"Resultado Tarea paralela {i+1}: {str(res)[:150]}...") # Print truncated results
-    # else:
-    #      logging.warning("No tasks were added for parallel execution (check API keys/image path).")
+async def _precalentar(session, url):
+    # HEAD has no body, so the connection goes straight back to the pool, TLS already negotiated
+    async with session.head(url, timeout=aiohttp.ClientTimeout(total=5)) as resp:
+        return resp.status
+
+
+async def precalentar_conexiones(session):
+    """Opens the TLS connections to the remote APIs up front, so the first real calls skip the handshake."""
+    urls = []
+    if OPENAI_API_KEY:
+        urls.append("https://api.openai.com")
+    if GROQ_API_KEY:
+        urls.append("https://api.groq.com")
+    if not urls:
+        return
+    inicio = time.perf_counter()
+    resultados = await asyncio.gather(*(_precalentar(session, url) for url in urls), return_exceptions=True)
+    for url, res in zip(urls, resultados):
+        if isinstance(res, Exception):
+            logger.warning("No se pudo precalentar la conexión a %s: %s", url, res) # Not fatal: the real call will retry
+    logger.info("Conexiones precalentadas (%s) en %.3fs", ", ".join(urls), time.perf_counter() - inicio)
+
+
+def _trace_config(contadores):
+    """Counts new connections, reused connections and DNS lookups made by the session."""
+    def contar(clave):
+        async def handler(session, trace_config_ctx, params):
+            contadores[clave] += 1
+        return handler
+
+    tc = aiohttp.TraceConfig()
+    tc.on_connection_create_start.append(contar("creadas"))
+    tc.on_connection_reuseconn.append(contar("reutilizadas"))
+    tc.on_dns_resolvehost_start.append(contar("dns"))
+    tc.on_dns_cache_hit.append(contar("dns_cache"))
+    return tc
+
+
+async def main(trace=False):
+    logger.info("Ejecutando ejemplos de aaus_llm (cargando config desde .env)...")
+
+    if MAX_CONCURRENCY:
+        logger.info("Límites de concurrencia por proveedor: %s", MAX_CONCURRENCY)
+        configure(concurrency=MAX_CONCURRENCY)
+
+    # One aiohttp session per application, not per request: every example (sequential or in
+    # parallel) shares its connection pool, so connections and TLS sessions are reused instead
+    # of re-opened per call. The connector is tuned above aiohttp's default 100-connection limit,
+    # and enable_cleanup_closed aborts TLS transports the server closed uncleanly, so they are not leaked.
+    # OpenAI calls use this pool too (HTTP/1.1, one request per connection), so limit_per_host must
+    # stay at or above the OpenAI concurrency cap (20 by default) or requests wait for a free connection.
+    connector = aiohttp.TCPConnector(
+        limit=POOL_LIMIT,
+        limit_per_host=POOL_PER_HOST,
+        ttl_dns_cache=300,
+        keepalive_timeout=75,
+        enable_cleanup_closed=True
+    )
+    contadores = {"creadas": 0, "reutilizadas": 0, "dns": 0, "dns_cache": 0}
+    session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=120),
+        # aaus_llm already encodes its own request bodies (base64 images included) with orjson when it
+        # is installed; this makes any other `json=` request sent through the shared session use it too
+        json_serialize=_json_dumps,
+        trace_configs=[_trace_config(contadores)] if trace else None
+    )
+    async with session: # Closed once, when all examples are done
+        # Warm-up runs in the background, overlapping with the examples (the local Ollama ones never
+        # wait for it); awaiting it first would add a full round trip before the first query
+        precalentamiento = asyncio.ensure_future(precalentar_conexiones(session))
+        try:
+            async with AausLLM(session=session) as llm:
+                await ejecutar_ejemplos(llm)
+        finally:
+            if not precalentamiento.done():
+                precalentamiento.cancel() # Nothing left to warm up for
+            await asyncio.gather(precalentamiento, return_exceptions=True)
+
+    if trace:
+        # With keep-alive working, "creadas" stays around one per host; one per request means the pool is not reused
+        logger.info(
+            "Conexiones: %d creadas, %d reutilizadas; DNS: %d resoluciones, %d desde caché",
+            contadores["creadas"], contadores["reutilizadas"], contadores["dns"], contadores["dns_cache"]
+        )
+
+
+async def _ejecutar_en_paralelo(tareas):
+    """
+    Runs the (label, coroutine) pairs concurrently and returns their results in order.
+    Recoverable provider errors (missing key, 429 after the retries, unreachable Ollama) are
+    already turned into result strings by ejecutar_ejemplo. A fatal one (TLS, rejected
+    credentials) or a bug cancels the sibling tasks right away, freeing their connections,
+    instead of waiting for all of them like gather(return_exceptions=True) would.
+    """
+    if hasattr(asyncio, "TaskGroup"): # Python 3.11+
+        async with asyncio.TaskGroup() as tg:
+            handles = [tg.create_task(coro, name=etiqueta) for etiqueta, coro in tareas]
+    else:
+        handles = [asyncio.ensure_future(coro) for _, coro in tareas]
+        if handles: # asyncio.wait rejects an empty set
+            hechas, pendientes = await asyncio.wait(handles, return_when=asyncio.FIRST_EXCEPTION)
+            for tarea in pendientes:
+                tarea.cancel()
+            await asyncio.gather(*pendientes, return_exceptions=True)
+            for tarea in hechas:
+                if tarea.exception() is not None:
+                    raise tarea.exception()
+    return [h.result() for h in handles]
+
+
+async def ejecutar_ejemplos(llm):
+    # Build each example coroutine exactly once, only for the examples whose requirements are met.
+    # Requests to the same provider are not merged into one: the chat APIs have no batch input for
+    # independent prompts (OpenAI's `n` only samples one prompt several times, and chaining prompts
+    # in one conversation would change the answers). They run concurrently over the same warm
+    # keep-alive connection pool instead, so the extra cost per request is small.
+    tareas = [(spec["nombre"], ejecutar_ejemplo(spec, llm)) for spec in EJEMPLOS if _habilitado(spec)]
+
+    if os.environ.get("AAUS_SEQUENTIAL"):
+        # Debug mode: one request at a time, so logs from different providers do not interleave
+        logger.info("\n--- Ejecutando %d tareas en secuencia (AAUS_SEQUENTIAL) ---", len(tareas))
+        resultados = []
+        for _, tarea in tareas:
+            try:
+                resultados.append(await tarea)
+            except Exception as e:
+                resultados.append(e)
+    else:
+        # Default: total time is the slowest request instead of the sum of all of them
+        logger.info("\n--- Ejecutando %d tareas en paralelo ---", len(tareas))
+        try:
+            resultados = await _ejecutar_en_paralelo(tareas)
+        except Exception as e: # ExceptionGroup on 3.11+
+            logger.error("Ejecución en paralelo abortada, tareas restantes canceladas: %r", e)
+            return
+
+    logger.info("\n--- Resultados ---")
+    for (etiqueta, _), res in zip(tareas, resultados):
+        if isinstance(res, Exception):
+            logger.error("Tarea %s falló: %s", etiqueta, res)
+        else:
+            logger.info("Resultado %s: %.150s...", etiqueta, res) # Print truncated results
 
 if __name__ == "__main__":
     # To run this example:
     # 1. Install the aaus_llm package (`pip install .` or `pip install -e .`)
     # 2. Install python-dotenv (`pip install python-dotenv`)
     # 3. Create a .env file in this directory with your API Keys (OPENAI_API_KEY, GROQ_API_KEY)
-    #    and optionally IMAGE_PATH and OLLAMA_BASE_URL.
+    #    (not read if AAUS_SKIP_DOTENV=1)
+    #    and optionally IMAGE_PATH, OLLAMA_BASE_URL, AAUS_MAX_CONCURRENCY_<OPENAI|GROQ|OLLAMA>
+    #    and the connection pool size (AAUS_POOL_LIMIT, default 200; AAUS_POOL_PER_HOST, default 64).
     # 4. Ensure Ollama server is running (for Ollama tests) and models are pulled (`ollama pull llama3`, `ollama pull llava`).
     # 5. Run this script: python usage_example.py
-    asyncio.run(main())
\ No newline at end of file
+    #    All enabled examples run in parallel; set AAUS_SEQUENTIAL=1 to run them one at a time.
+    #    Identical queries are answered once per process; set AAUS_NO_CACHE=1 to disable that.
+    #    Pass --trace to log how many connections were created vs. reused (checks that keep-alive works).
+    #    With uvloop installed (`pip install ".[fast]"`, not available on Windows) it is used as the event loop.
+    parser = argparse.ArgumentParser(description="Ejemplos de uso de aaus_llm")
+    parser.add_argument("--trace", action="store_true", help="Cuenta las conexiones HTTP creadas y reutilizadas")
+    args = parser.parse_args()
+
+    try:
+        import uvloop # libuv-based event loop, faster for many concurrent HTTPS requests
+    except ImportError:
+        uvloop = None
+
+    if uvloop is None:
+        asyncio.run(main(trace=args.trace))
+    elif sys.version_info >= (3, 11):
+        # Same semantics as asyncio.run (task cancellation, loop close), just with uvloop's loop
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            runner.run(main(trace=args.trace))
+    else:
+        uvloop.install()
+        asyncio.run(main(trace=args.trace))
\ No newline at end of file